@@ -1,13 +1,61 @@
 import os
+import sys
 import argparse
 from . import rotator
 
 DEFAULT_CREDENTIALS_FILE = os.path.expanduser("~/.aws/credentials")
+DEFAULT_MAX_WORKERS = 16
 
 # Removes some of the extra verbosity in the log messages.
 os.environ["COLOREDLOGS_LOG_FORMAT"] = "%(message)s"
 
 
+def positive_int(value):
+    """
+    argparse type for arguments that must be a positive integer.
+
+    Args:
+        value (str): The raw argument value.
+
+    Returns:
+        int: The parsed value.
+
+    Raises:
+        argparse.ArgumentTypeError: If the value isn't a positive integer.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError("{} is not a positive integer".format(value))
+    return number
+
+
+def non_negative_int(value):
+    """
+    argparse type for arguments that must be zero or a positive integer.
+
+    Args:
+        value (str): The raw argument value.
+
+    Returns:
+        int: The parsed value.
+
+    Raises:
+        argparse.ArgumentTypeError: If the value isn't a non-negative integer.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise argparse.ArgumentTypeError(
+            "{} is not a non-negative integer".format(value)
+        )
+    return number
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -19,6 +67,18 @@ def parse_args():
     parser.add_argument(
         "-v", "--verbose", action="store_true", default=False, help="Verbose output"
     )
+    parser.add_argument(
+        "--max-workers",
+        type=positive_int,
+        default=DEFAULT_MAX_WORKERS,
+        help="Maximum number of profiles to rotate concurrently",
+    )
+    parser.add_argument(
+        "--min-age-days",
+        type=non_negative_int,
+        default=0,
+        help="Skip profiles whose only active key is younger than this many days",
+    )
 
     include_or_exclude_list = parser.add_mutually_exclusive_group()
     include_or_exclude_list.add_argument(
@@ -33,4 +93,8 @@ def parse_args():
 
 
 def main():
-    rotator.IAMKeyRotator(parse_args()).main()
+    try:
+        rotator.IAMKeyRotator(parse_args()).main()
+    except rotator.RotationFailed:
+        # Each failure has already been logged against its profile.
+        sys.exit(1)
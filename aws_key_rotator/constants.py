@@ -3,9 +3,14 @@ INACTIVE = "Inactive"
 
 AWS_ACCESS_KEY_ID = "aws_access_key_id"
 AWS_SECRET_ACCESS_KEY = "aws_secret_access_key"
+AWS_SESSION_TOKEN = "aws_session_token"
+AWS_REGION = "region"
+AWS_CA_BUNDLE = "ca_bundle"
+AWS_KEYPAIR = frozenset((AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY))
 
 BOTO_ACCESS_KEY = "AccessKey"
 BOTO_ACCESS_KEY_ID = "AccessKeyId"
 BOTO_SECRET_ACCESS_KEY = "SecretAccessKey"
 
 BOTO_ACCESS_KEY_METADATA = "AccessKeyMetadata"
+BOTO_CREATE_DATE = "CreateDate"
@@ -1,43 +1,90 @@
+import datetime
+import io
 import logging
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from time import sleep
 from configparser import ConfigParser
 from contextlib import contextmanager
-from collections import namedtuple
 
-import boto3
+import botocore.session
 import coloredlogs
 from botocore.exceptions import ClientError
 
 from . import constants
 
-AccessKey = namedtuple("AccessKey", "id,status")
+# Credentials file contents, keyed on path and mapped to the (st_mtime_ns, st_size)
+# they were read at, along with the contents themselves.
+_CONTENTS_CACHE = {}
 
 
 class MaximumRetriesExceeded(Exception):
     pass
 
 
-def retry(attempts, sleep_time):
+class RotationFailed(Exception):
     """
-    Retry decorator.
+    Raised once every profile has been attempted, if any of them failed to rotate.
+
+    Attributes:
+        profiles (List[str]): Names of the profiles that failed.
+    """
+
+    def __init__(self, profiles):
+        super().__init__(
+            "Credential rotation failed for profiles: {}".format(", ".join(profiles))
+        )
+        self.profiles = profiles
+
+
+def _file_signature(path):
+    """
+    Returns a signature that changes whenever the given file is modified.
+
+    Args:
+        path (str): Path to the file.
+
+    Returns:
+        Tuple[int, int]: The file's mtime (in nanoseconds) and size, or None if the
+        file can't be stat'ed.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def retry(attempts, base_delay, max_delay):
+    """
+    Retry decorator with exponential backoff and jitter.
+
+    The delay before retry n is min(max_delay, base_delay * 2**n), scaled by a
+    random factor between 0.5 and 1. Only InvalidClientTokenId errors are retried;
+    any other error is raised immediately.
 
     Args:
         attempts (int): Number of attempts before throwing MaximumRetriesExceeded
-        sleep_time (int): Time to sleep between attempts.
+        base_delay (float): Time to sleep after the first failed attempt.
+        max_delay (float): Upper bound on the time to sleep between attempts.
     Raises:
         MaximumRetriesExceeded
     """
 
     def inner(fn):
         def _inner(*args, **kwargs):
-            for _ in range(attempts):
+            for attempt in range(attempts):
                 try:
                     return fn(*args, **kwargs)
                 except ClientError as error:
-                    if error.response["Error"]["Code"] == "InvalidClientTokenId":
-                        sleep(sleep_time)
-                    else:
+                    if error.response["Error"]["Code"] != "InvalidClientTokenId":
                         raise error
+                    # No point sleeping if there isn't another attempt to make.
+                    if attempt < attempts - 1:
+                        delay = min(max_delay, base_delay * 2**attempt)
+                        sleep(delay * random.uniform(0.5, 1.0))
             raise MaximumRetriesExceeded
 
         return _inner
@@ -58,29 +105,107 @@ class IAMKeyRotator:
         self.log = logging.getLogger(__name__)
         log_level = "DEBUG" if config.verbose else "INFO"
         coloredlogs.install(level=log_level, logger=self.log)
+        # Every profile is passed in explicitly, so don't let AWS_PROFILE scope the
+        # shared session; botocore raises ProfileNotFound if it names a profile that
+        # isn't in the config files.
+        self._botocore_session = botocore.session.Session(
+            session_vars={"profile": (None, None, None, None)}
+        )
+        self._client_lock = threading.Lock()
+        self._iam_clients = {}
+        self._credentials_lock = threading.Lock()
+        self._contents = None
+        self._parser = None
+        self._dirty = False
+        self._access_key_cache = {}
+
+    def _read_credentials(self):
+        """
+        Reads the credentials file. If the file hasn't changed since it was last read,
+        the cached contents are returned instead.
+
+        Returns:
+            str: Contents of the AWS credentials file.
+        """
+        path = self.config.credentials
+        signature = _file_signature(path)
+        cached = _CONTENTS_CACHE.get(path)
+        if signature is not None and cached is not None and cached[0] == signature:
+            self.log.debug("Using cached credentials file %s", path)
+            return cached[1]
+        with open(path, "r") as fp:
+            self.log.debug("Reading credentials file %s", path)
+            contents = fp.read()
+        # Cache against the signature taken before the read, so that if the file
+        # changes in the meantime the entry is simply a miss next time, rather than
+        # stale contents being cached under the new signature.
+        self._cache_contents(contents, signature)
+        return contents
+
+    def _cache_contents(self, contents, signature):
+        """
+        Caches the contents of the credentials file against the given signature.
+
+        Args:
+            contents (str): Contents of the AWS credentials file.
+            signature (Tuple[int, int]): Signature of the file the contents match, as
+            returned by _file_signature().
+        """
+        path = self.config.credentials
+        if signature is not None:
+            _CONTENTS_CACHE[path] = (signature, contents)
+
+    def _get_contents(self):
+        """
+        Returns the contents of the credentials file, reading it on first use. The
+        caller must hold self._credentials_lock.
+
+        Returns:
+            str: Contents of the AWS credentials file.
+        """
+        if self._contents is None:
+            self._contents = self._read_credentials()
+        return self._contents
 
     @contextmanager
     def _credentials(self):
         """
-        Wrapper around parsing the credentials file, then writing it back if any
-        changes are made.
+        Wrapper around the parsed credentials file, writing it back if any changes are
+        made. The file is only parsed the first time this is entered; afterwards the
+        same in-memory ConfigParser is reused for the rest of the run. Profiles are
+        rotated concurrently, so access is locked for the duration of the block.
+
+        Callers that modify the parser must set self._dirty so the changes are
+        written back to disk when the block exits.
 
         Use this as a context manager - e.g.:
 
         with self._credentials() as parser:
             do_stuff(parser)
+            self._dirty = True
 
         Yields:
             ConfigParser: ConfigParser object around the AWS credentials file.
         """
-        parser = ConfigParser()
-        with open(self.config.credentials, "r") as fp:
-            self.log.debug("Reading credentials file %s", self.config.credentials)
-            parser.read_string(fp.read())
-        yield parser
-        with open(self.config.credentials, "w") as fp:
-            self.log.debug("Writing to credentials file %s", self.config.credentials)
-            parser.write(fp)
+        with self._credentials_lock:
+            if self._parser is None:
+                self._parser = ConfigParser()
+                self._parser.read_string(self._get_contents())
+            yield self._parser
+            if self._dirty:
+                buffer = io.StringIO()
+                self._parser.write(buffer)
+                self._contents = buffer.getvalue()
+                with open(self.config.credentials, "w") as fp:
+                    self.log.debug(
+                        "Writing to credentials file %s", self.config.credentials
+                    )
+                    fp.write(self._contents)
+                # There's no way to stat the file atomically with the write, so rather
+                # than risk caching our contents under someone else's signature, drop
+                # the entry and let the next read repopulate it.
+                _CONTENTS_CACHE.pop(self.config.credentials, None)
+                self._dirty = False
 
     @staticmethod
     def _contains_keypair(section):
@@ -94,17 +219,17 @@ class IAMKeyRotator:
         Returns:
             bool: Whether this section contains aws_access_key_id and aws_secret_access_key.
         """
-        try:
-            section[constants.AWS_ACCESS_KEY_ID]
-            section[constants.AWS_SECRET_ACCESS_KEY]
-            return True
-        except KeyError:
-            return False
+        return constants.AWS_KEYPAIR.issubset(section)
 
-    def _get_rotatable_profiles(self):
+    def _get_rotatable_profiles(self, include=None, exclude=frozenset()):
         """
         Parses the credentials file and returns a list of all profiles that contain
-        both an aws_access_key_id and aws_secret_access_key.
+        both an aws_access_key_id and aws_secret_access_key. Profiles filtered out by
+        include or exclude are skipped without being inspected.
+
+        Args:
+            include (Set[str]): If given, only these profiles are considered.
+            exclude (Set[str]): Profiles that are never considered.
 
         Returns:
             List[str]: List of available profiles that contain access key IDs.
@@ -113,43 +238,141 @@ class IAMKeyRotator:
             profiles = [
                 section
                 for section in parser.sections()
-                if self._contains_keypair(parser[section])
+                if (include is None or section in include)
+                and section not in exclude
+                and self._contains_keypair(parser[section])
             ]
         self.log.debug("Found profiles: %s", profiles)
         return profiles
 
     def _get_boto_session(self, profile_name):
         """
-        Instantiates a boto session.
+        Returns an IAM client for the given profile, creating one from the profile's
+        keys in the credentials file only if one isn't already cached for that profile.
 
         Args:
             profile_name (str): Name of the connection profile to use for boto3.
 
         Returns:
-            boto3.Session
+            botocore.client.IAM
         """
-        self.log.debug("Instantiating boto session with profile %s", profile_name)
-        return boto3.Session(profile_name=profile_name).client("iam")
+        if profile_name not in self._iam_clients:
+            self.log.debug("Creating IAM client with profile %s", profile_name)
+            with self._credentials() as parser:
+                section = parser[profile_name]
+                access_key_id = section[constants.AWS_ACCESS_KEY_ID]
+                secret_access_key = section[constants.AWS_SECRET_ACCESS_KEY]
+                session_token = section.get(constants.AWS_SESSION_TOKEN)
+            self._iam_clients[profile_name] = self._create_client(
+                profile_name, "iam", access_key_id, secret_access_key, session_token
+            )
+        return self._iam_clients[profile_name]
+
+    def _create_client(
+        self,
+        profile_name,
+        service_name,
+        access_key_id,
+        secret_access_key,
+        session_token=None,
+    ):
+        """
+        Creates a client with the given credentials from the shared botocore session,
+        so that service models, endpoint data and the AWS config files are only
+        loaded once per run. botocore sessions aren't thread-safe, so client creation
+        is serialized.
+
+        The shared session isn't scoped to any profile, so the region and CA bundle
+        from the profile's section of ~/.aws/config are passed in explicitly, if the
+        profile has one there. Profiles that only exist in the credentials file given
+        by --credentials fall back to the session's unscoped defaults.
+
+        Args:
+            profile_name (str): Name of the connection profile to use for boto3.
+            service_name (str): Name of the AWS service, e.g. "iam".
+            access_key_id (str): Access key ID to sign requests with.
+            secret_access_key (str): Secret access key to sign requests with.
+            session_token (str): Session token, if the credentials are temporary.
+
+        Returns:
+            botocore.client.BaseClient
+        """
+        with self._client_lock:
+            profile_config = self._botocore_session.full_config["profiles"].get(
+                profile_name, {}
+            )
+            return self._botocore_session.create_client(
+                service_name,
+                region_name=profile_config.get(constants.AWS_REGION),
+                verify=profile_config.get(constants.AWS_CA_BUNDLE),
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=secret_access_key,
+                aws_session_token=session_token,
+            )
 
     def _get_access_keys(self, iam):
         """
         Retrieves the users' access keys.
 
         Args:
-            iam (boto3.Session): Boto3 session.
+            iam (botocore.client.IAM): IAM client.
 
         Returns:
-            List[AccessKey]: List of access keys and their status.
+            Tuple[Tuple[str, ...], Tuple[bool, ...], Tuple[datetime, ...]]: The access
+            key IDs, and in the same order, whether each key is active and when it was
+            created.
         """
-        access_keys = [
-            AccessKey(
-                id=key[constants.BOTO_ACCESS_KEY_ID],
-                status=key["Status"] == constants.ACTIVE,
+        keys = [
+            (
+                key[constants.BOTO_ACCESS_KEY_ID],
+                key["Status"] == constants.ACTIVE,
+                key[constants.BOTO_CREATE_DATE],
             )
-            for key in iam.list_access_keys()[constants.BOTO_ACCESS_KEY_METADATA]
+            for page in iam.get_paginator("list_access_keys").paginate()
+            for key in page[constants.BOTO_ACCESS_KEY_METADATA]
         ]
-        self.log.debug("Found access keys: %s", access_keys)
-        return access_keys
+        ids, statuses, create_dates = tuple(zip(*keys)) if keys else ((), (), ())
+        self.log.debug("Found access keys: %s (active: %s)", ids, statuses)
+        return ids, statuses, create_dates
+
+    def _get_profile_access_keys(self, profile_name):
+        """
+        Retrieves the access keys of the user behind the given profile.
+
+        Args:
+            profile_name (str): Name of the connection profile to use for boto3.
+
+        Returns:
+            Tuple[Tuple[str, ...], Tuple[bool, ...], Tuple[datetime, ...]]: See
+            _get_access_keys().
+        """
+        return self._get_access_keys(self._get_boto_session(profile_name))
+
+    def _prefetch_access_keys(self, profiles):
+        """
+        Retrieves the access keys for all of the given profiles concurrently, so that
+        the listing round trips overlap rather than happening one profile at a time.
+
+        A profile whose listing fails is left out of the cache, so that
+        rotate_credentials() lists its keys again and fails for that profile alone,
+        without stopping the others from being rotated.
+
+        Args:
+            profiles (List[str]): Names of the connection profiles to use for boto3.
+        """
+        max_workers = min(self.config.max_workers, len(profiles))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                profile: executor.submit(self._get_profile_access_keys, profile)
+                for profile in profiles
+            }
+        for profile, future in futures.items():
+            try:
+                self._access_key_cache[profile] = future.result()
+            except Exception as error:  # pylint: disable=broad-except
+                self.log.debug(
+                    "Could not prefetch access keys for profile %s: %s", profile, error
+                )
 
     def _create_key(self, profile_name):
         """
@@ -173,16 +396,39 @@ class IAMKeyRotator:
             parser[profile_name][constants.AWS_SECRET_ACCESS_KEY] = new_key[
                 constants.BOTO_SECRET_ACCESS_KEY
             ]
+            self._dirty = True
         self.log.debug("Wrote new credentials for profile %s", profile_name)
+        self._wait_key_active(profile_name, new_key)
+
+    def _wait_key_active(self, profile_name, new_key):
+        """
+        Waits for newly created credentials to propagate, by polling
+        sts:GetCallerIdentity with them until it stops failing with
+        InvalidClientTokenId. The cached IAM client for the profile is then replaced
+        with one using the new credentials.
+
+        Args:
+            profile_name (str): Name of the connection profile to use for boto3.
+            new_key (dict): The AccessKey returned by create_access_key.
+        """
+        # Pass the new key in directly, rather than re-reading it from the
+        # credentials file we just wrote.
+        access_key_id = new_key[constants.BOTO_ACCESS_KEY_ID]
+        secret_access_key = new_key[constants.BOTO_SECRET_ACCESS_KEY]
+        sts = self._create_client(profile_name, "sts", access_key_id, secret_access_key)
+        self.log.debug("Waiting for new credentials for profile %s", profile_name)
+        retry(attempts=20, base_delay=0.5, max_delay=15)(sts.get_caller_identity)()
+        self._iam_clients[profile_name] = self._create_client(
+            profile_name, "iam", access_key_id, secret_access_key
+        )
 
-    @retry(attempts=20, sleep_time=3)
     def _inactivate_key(self, profile_name, access_key_id):
         """
         Inactivates the given access key.
 
         This is usually called immediately after _create_key() is called, which does
-        update the credentials file locally. The retry decorator ensures that this is
-        being called with the correct, new credentials.
+        update the credentials file locally and waits for the new credentials to
+        become valid, so this is being called with the correct, new credentials.
 
         Args:
             profile_name (str): Name of the connection profile to use for boto3.
@@ -214,52 +460,84 @@ class IAMKeyRotator:
             profile_name (str): Name of the connection profile to use for boto3.
         """
         self.log.info("Performing credential rotation for profile %s", profile_name)
-        iam = self._get_boto_session(profile_name)
-        access_keys = self._get_access_keys(iam)
-        statuses = [access_key.status for access_key in access_keys]
+        access_keys = self._access_key_cache.pop(profile_name, None)
+        if access_keys is None:
+            access_keys = self._get_profile_access_keys(profile_name)
+        ids, statuses, create_dates = access_keys
+        # Only skip a profile that has a single active key. Two active keys mean an
+        # earlier rotation didn't finish inactivating the old one, which must always
+        # be cleaned up however new the other key is.
+        min_age = datetime.timedelta(days=self.config.min_age_days)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if min_age and statuses.count(True) == 1:
+            active_create_date = create_dates[statuses.index(True)]
+            if now - active_create_date < min_age:
+                self.log.info(
+                    "Skipping profile %s, its active access key is less than %s "
+                    "day(s) old",
+                    profile_name,
+                    self.config.min_age_days,
+                )
+                return
 
         # Handling deletions and inactivations prior to issuing a new key. If we need
-        # to delete a key due to the two key limit, we must do that first.
+        # to delete a key due to the two key limit, we must do that first. These calls
+        # can't be overlapped: create_access_key fails with LimitExceeded until the
+        # delete has completed, and the inactivation needs the newly created key.
 
-        if statuses == [True]:
-            old_key = access_keys[0]
+        if statuses == (True,):
             self._create_key(profile_name)
-            self._inactivate_key(profile_name, old_key.id)
-        elif statuses in ([True, False], [False, True]):
+            self._inactivate_key(profile_name, ids[0])
+        elif statuses in ((True, False), (False, True)):
             # Delete inactive key, use "current" active key to issue new key,
             # then deactivate the "current" key.
-            if access_keys[0].status:
-                current_active = access_keys[0]
-                current_inactive = access_keys[1]
+            if statuses[0]:
+                current_active, current_inactive = ids
             else:
-                current_active = access_keys[1]
-                current_inactive = access_keys[0]
-            self._delete_key(profile_name, current_inactive.id)
+                current_inactive, current_active = ids
+            self._delete_key(profile_name, current_inactive)
             self._create_key(profile_name)
-            self._inactivate_key(profile_name, current_active.id)
-        elif statuses == [True, True]:
+            self._inactivate_key(profile_name, current_active)
+        elif statuses == (True, True):
             # Delete the key that does *not* match the one in the credentials file.
             # Then generate a new key and inactivate the old.
             with self._credentials() as parser:
                 key_id_in_file = parser[profile_name][constants.AWS_ACCESS_KEY_ID]
-            if key_id_in_file == access_keys[0].id:
-                key_to_delete = access_keys[1]
-                key_to_inactivate = access_keys[0]
+            if key_id_in_file == ids[0]:
+                key_to_inactivate, key_to_delete = ids
             else:
-                key_to_delete = access_keys[0]
-                key_to_inactivate = access_keys[1]
-            self._delete_key(profile_name, key_to_delete.id)
+                key_to_delete, key_to_inactivate = ids
+            self._delete_key(profile_name, key_to_delete)
             self._create_key(profile_name)
-            self._inactivate_key(profile_name, key_to_inactivate.id)
+            self._inactivate_key(profile_name, key_to_inactivate)
         self.log.info("Credential rotation successful for profile %s!", profile_name)
 
     def main(self):
-        profiles = set(self._get_rotatable_profiles())
-        if self.config.include:
-            profiles &= set(self.config.include.split(","))
-            self.log.debug("Profiles after inclusions: %s", profiles)
-        if self.config.exclude:
-            profiles -= set(self.config.exclude.split(","))
-            self.log.debug("Profiles after exclusions: %s", profiles)
-        for profile in profiles:
-            self.rotate_credentials(profile)
+        include = set(self.config.include.split(",")) if self.config.include else None
+        exclude = set(self.config.exclude.split(",")) if self.config.exclude else set()
+        profiles = self._get_rotatable_profiles(include, exclude)
+        if not profiles:
+            return
+        # Each profile is an independent IAM user, and rotation is entirely bound by
+        # network latency, so rotate them in parallel.
+        self._prefetch_access_keys(profiles)
+        max_workers = min(self.config.max_workers, len(profiles))
+        failed = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(self.rotate_credentials, profile): profile
+                for profile in profiles
+            }
+            # A profile can fail part way through, e.g. leaving two active keys, so
+            # every failure is logged rather than just the first.
+            for future in as_completed(futures):
+                profile = futures[future]
+                try:
+                    future.result()
+                except Exception as error:  # pylint: disable=broad-except
+                    self.log.error(
+                        "Credential rotation failed for profile %s: %s", profile, error
+                    )
+                    failed.append(profile)
+        if failed:
+            raise RotationFailed(sorted(failed))
@@ -3,10 +3,10 @@ import types
 from unittest.mock import patch, mock_open
 
 import pytest
-import boto3
+from botocore.exceptions import ClientError
 import datetime
 
-from aws_key_rotator import __version__, rotator
+from aws_key_rotator import __version__, cli, rotator
 
 
 def credential_section(profile_name, access_key_and_secret_id):
@@ -18,11 +18,15 @@ aws_secret_access_key = {access_key_and_secret_id}
     )
 
 
+KEY_AGE = datetime.timedelta(days=30)
+KEY_CREATE_DATE = datetime.datetime.now(datetime.timezone.utc) - KEY_AGE
+
 ACCESS_KEY_RESPONSE_ONE_KEY = {
     "AccessKeyMetadata": [
         {
             "AccessKeyId": "asdf",
             "Status": "Active",
+            "CreateDate": KEY_CREATE_DATE,
         }
     ]
 }
@@ -32,10 +36,12 @@ ACCESS_KEY_RESPONSE_TWO_KEYS_ONE_ACTIVE = {
         {
             "AccessKeyId": "asdf",
             "Status": "Active",
+            "CreateDate": KEY_CREATE_DATE,
         },
         {
             "AccessKeyId": "sdfg",
             "Status": "Inactive",
+            "CreateDate": KEY_CREATE_DATE,
         },
     ]
 }
@@ -45,10 +51,12 @@ ACCESS_KEY_RESPONSE_TWO_KEYS_BOTH_ACTIVE = {
         {
             "AccessKeyId": "asdf",
             "Status": "Active",
+            "CreateDate": KEY_CREATE_DATE,
         },
         {
             "AccessKeyId": "sdfg",
             "Status": "Active",
+            "CreateDate": KEY_CREATE_DATE,
         },
     ]
 }
@@ -56,10 +64,10 @@ ACCESS_KEY_RESPONSE_TWO_KEYS_BOTH_ACTIVE = {
 
 @pytest.fixture(scope="function")
 def mock_iam_one_key():
-    with patch("aws_key_rotator.rotator.boto3") as mock_boto:
-        mock_session = mock_boto.Session()
-        mock_iam = mock_session.client()
-        mock_iam.list_access_keys.return_value = ACCESS_KEY_RESPONSE_ONE_KEY
+    with patch("aws_key_rotator.rotator.botocore") as mock_botocore:
+        mock_session = mock_botocore.session.Session()
+        mock_iam = mock_session.create_client()
+        mock_iam.get_paginator().paginate.return_value = [ACCESS_KEY_RESPONSE_ONE_KEY]
         mock_iam.create_access_key.return_value = {
             "AccessKey": {
                 "AccessKeyId": "asdf2",
@@ -71,10 +79,12 @@ def mock_iam_one_key():
 
 @pytest.fixture(scope="function")
 def mock_iam_two_keys_one_inactive():
-    with patch("aws_key_rotator.rotator.boto3") as mock_boto:
-        mock_session = mock_boto.Session()
-        mock_iam = mock_session.client()
-        mock_iam.list_access_keys.return_value = ACCESS_KEY_RESPONSE_TWO_KEYS_ONE_ACTIVE
+    with patch("aws_key_rotator.rotator.botocore") as mock_botocore:
+        mock_session = mock_botocore.session.Session()
+        mock_iam = mock_session.create_client()
+        mock_iam.get_paginator().paginate.return_value = [
+            ACCESS_KEY_RESPONSE_TWO_KEYS_ONE_ACTIVE
+        ]
         mock_iam.create_access_key.return_value = {
             "AccessKey": {
                 "AccessKeyId": "asdf2",
@@ -86,12 +96,12 @@ def mock_iam_two_keys_one_inactive():
 
 @pytest.fixture(scope="function")
 def mock_iam_two_keys_both_active():
-    with patch("aws_key_rotator.rotator.boto3") as mock_boto:
-        mock_session = mock_boto.Session()
-        mock_iam = mock_session.client()
-        mock_iam.list_access_keys.return_value = (
+    with patch("aws_key_rotator.rotator.botocore") as mock_botocore:
+        mock_session = mock_botocore.session.Session()
+        mock_iam = mock_session.create_client()
+        mock_iam.get_paginator().paginate.return_value = [
             ACCESS_KEY_RESPONSE_TWO_KEYS_BOTH_ACTIVE
-        )
+        ]
         mock_iam.create_access_key.return_value = {
             "AccessKey": {
                 "AccessKeyId": "asdf2",
@@ -104,7 +114,12 @@ def mock_iam_two_keys_both_active():
 @pytest.fixture(scope="function")
 def config():
     yield types.SimpleNamespace(
-        credentials="~/.aws/credentials", verbose=False, include=None, exclude=None
+        credentials="~/.aws/credentials",
+        verbose=False,
+        include=None,
+        exclude=None,
+        max_workers=16,
+        min_age_days=0,
     )
 
 
@@ -135,6 +150,129 @@ def test_two_profiles(config, mock_iam_one_key):
     assert write_one and write_two
 
 
+@pytest.mark.parametrize("include,exclude", [("nondefault", None), (None, "default")])
+def test_include_exclude(config, mock_iam_one_key, include, exclude):
+    """
+    Only the included (or non-excluded) profile should be rotated.
+    """
+    config.include = include
+    config.exclude = exclude
+    creds_data = "{}\n\n{}".format(
+        credential_section("default", "asdf"), credential_section("nondefault", "asdf")
+    )
+    fake_creds_fp = mock_open(read_data=creds_data)
+    with patch("builtins.open", fake_creds_fp):
+        rotator.IAMKeyRotator(config).main()
+    writes = "".join([call[0][0] for call in fake_creds_fp().write.call_args_list])
+    assert credential_section("default", "asdf") in writes
+    assert credential_section("nondefault", "asdf2") in writes
+    assert mock_iam_one_key.create_access_key.call_count == 1
+
+
+def test_access_keys_prefetched(config, mock_iam_one_key):
+    """
+    Access keys are listed once per profile, up front, and reused during rotation.
+    """
+    creds_data = "{}\n\n{}".format(
+        credential_section("default", "asdf"), credential_section("nondefault", "asdf")
+    )
+    fake_creds_fp = mock_open(read_data=creds_data)
+    key_rotator = rotator.IAMKeyRotator(config)
+    with patch("builtins.open", fake_creds_fp):
+        key_rotator.main()
+    assert mock_iam_one_key.get_paginator().paginate.call_count == 2
+    assert key_rotator._access_key_cache == {}
+
+
+@pytest.mark.parametrize("min_age_days,rotated", [(7, True), (31, False)])
+@pytest.mark.parametrize(
+    "mock_iam_fixture", ["mock_iam_one_key", "mock_iam_two_keys_one_inactive"]
+)
+def test_min_age_days(config, request, mock_iam_fixture, min_age_days, rotated):
+    """
+    Profiles whose active key is younger than --min-age-days should be skipped.
+    """
+    mock_iam = request.getfixturevalue(mock_iam_fixture)
+    config.min_age_days = min_age_days
+    fake_creds_fp = mock_open(read_data=credential_section("default", "asdf"))
+    with patch("builtins.open", fake_creds_fp):
+        rotator.IAMKeyRotator(config).main()
+    assert mock_iam.create_access_key.called == rotated
+
+
+def test_min_age_days_two_active_keys_always_rotated(
+    config, mock_iam_two_keys_both_active
+):
+    """
+    Two active keys are left behind by an unfinished rotation, so the profile should
+    be rotated even if a key is younger than --min-age-days.
+    """
+    config.min_age_days = 31
+    fake_creds_fp = mock_open(read_data=credential_section("default", "asdf"))
+    with patch("builtins.open", fake_creds_fp):
+        rotator.IAMKeyRotator(config).main()
+    mock_iam_two_keys_both_active.delete_access_key.assert_called_once_with(
+        AccessKeyId="sdfg"
+    )
+    assert mock_iam_two_keys_both_active.create_access_key.called
+
+
+def test_failed_prefetch_does_not_block_other_profiles(config, mock_iam_one_key):
+    """
+    If listing one profile's access keys fails, the other profiles should still be
+    rotated, and only the failing profile should be reported.
+    """
+    error = ClientError({"Error": {"Code": "InvalidClientTokenId"}}, "ListAccessKeys")
+    creds_data = "{}\n\n{}".format(
+        credential_section("default", "asdf"), credential_section("broken", "bad")
+    )
+    fake_creds_fp = mock_open(read_data=creds_data)
+    key_rotator = rotator.IAMKeyRotator(config)
+    real_get_access_keys = key_rotator._get_profile_access_keys
+
+    def get_access_keys(profile_name):
+        if profile_name == "broken":
+            raise error
+        return real_get_access_keys(profile_name)
+
+    with patch("builtins.open", fake_creds_fp), patch.object(
+        key_rotator, "_get_profile_access_keys", side_effect=get_access_keys
+    ):
+        with pytest.raises(rotator.RotationFailed) as excinfo:
+            key_rotator.main()
+    assert excinfo.value.profiles == ["broken"]
+    writes = "".join([call[0][0] for call in fake_creds_fp().write.call_args_list])
+    assert credential_section("default", "asdf2") in writes
+    assert mock_iam_one_key.create_access_key.call_count == 1
+
+
+def test_every_failed_profile_reported(config, mock_iam_one_key, caplog):
+    """
+    When several profiles fail, each failure should be logged and reported, not just
+    the first.
+    """
+    creds_data = "\n\n".join(
+        credential_section(profile, "asdf") for profile in ("p0", "p1", "p2")
+    )
+    fake_creds_fp = mock_open(read_data=creds_data)
+    key_rotator = rotator.IAMKeyRotator(config)
+    real_rotate_credentials = key_rotator.rotate_credentials
+
+    def rotate_credentials(profile_name):
+        if profile_name != "p1":
+            raise RuntimeError("failed {}".format(profile_name))
+        return real_rotate_credentials(profile_name)
+
+    with patch("builtins.open", fake_creds_fp), patch.object(
+        key_rotator, "rotate_credentials", side_effect=rotate_credentials
+    ):
+        with pytest.raises(rotator.RotationFailed) as excinfo:
+            key_rotator.main()
+    assert excinfo.value.profiles == ["p0", "p2"]
+    assert "failed p0" in caplog.text and "failed p2" in caplog.text
+    assert mock_iam_one_key.create_access_key.call_count == 1
+
+
 def test_bad_credentials_nothing_happens(config, mock_iam_one_key):
     """
     If the credentials file doesn't contain both keys, nothing should happen.
@@ -175,5 +313,256 @@ def test_simple_rotation_both_active(config, mock_iam_two_keys_both_active):
     assert credential_section("default", "asdf2") in writes
 
 
+@pytest.mark.parametrize(
+    "mock_iam_fixture",
+    ["mock_iam_two_keys_one_inactive", "mock_iam_two_keys_both_active"],
+)
+def test_delete_before_create(config, request, mock_iam_fixture):
+    """
+    With two existing keys, one must be deleted before a new one can be created, and
+    the old key can only be inactivated after that.
+    """
+    mock_iam = request.getfixturevalue(mock_iam_fixture)
+    fake_creds_fp = mock_open(read_data=credential_section("default", "asdf"))
+    with patch("builtins.open", fake_creds_fp):
+        rotator.IAMKeyRotator(config).main()
+    calls = [
+        call[0]
+        for call in mock_iam.mock_calls
+        if call[0] in ("delete_access_key", "create_access_key", "update_access_key")
+    ]
+    assert calls == ["delete_access_key", "create_access_key", "update_access_key"]
+    mock_iam.delete_access_key.assert_called_once_with(AccessKeyId="sdfg")
+    mock_iam.update_access_key.assert_called_once_with(
+        AccessKeyId="asdf", Status="Inactive"
+    )
+
+
+def test_clients_reused_until_key_rotated(config, mock_iam_one_key):
+    """
+    All clients come from one shared botocore session, and an IAM client should only
+    be created once per set of credentials: once for the original key, and once more
+    for the new key.
+    """
+    fake_creds_fp = mock_open(read_data=credential_section("default", "asdf"))
+    with patch("builtins.open", fake_creds_fp):
+        rotator.IAMKeyRotator(config).main()
+    mock_session = rotator.botocore.session.Session
+    iam_calls = [
+        call
+        for call in mock_session.return_value.create_client.call_args_list
+        if call[0] == ("iam",)
+    ]
+    assert [call[1]["aws_access_key_id"] for call in iam_calls] == ["asdf", "asdf2"]
+    # One call from the fixture, one for the rotator's shared session.
+    assert mock_session.call_count == 2
+
+
+@pytest.mark.parametrize(
+    "profile_name,endpoint",
+    [
+        ("gov", "https://iam.us-gov.amazonaws.com"),
+        ("cn", "https://iam.cn-north-1.amazonaws.com.cn"),
+        ("elsewhere", "https://iam.amazonaws.com"),
+    ],
+)
+def test_client_uses_profile_config(
+    config, tmp_path, monkeypatch, profile_name, endpoint
+):
+    """
+    Clients should pick up the profile's settings from ~/.aws/config, so that
+    profiles outside the standard AWS partition reach the right endpoints. Profiles
+    that only exist in the --credentials file get the default endpoint.
+    """
+    aws_config = tmp_path / "config"
+    aws_config.write_text(
+        "[profile gov]\nregion = us-gov-west-1\n\n[profile cn]\nregion = cn-north-1\n"
+    )
+    creds_file = tmp_path / "credentials"
+    creds_file.write_text(credential_section(profile_name, "asdf"))
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(aws_config))
+    monkeypatch.setenv("AWS_SHARED_CREDENTIALS_FILE", str(tmp_path / "missing"))
+    # A profile that doesn't exist shouldn't affect clients for other profiles.
+    monkeypatch.setenv("AWS_PROFILE", "missing")
+    config.credentials = str(creds_file)
+    iam = rotator.IAMKeyRotator(config)._get_boto_session(profile_name)
+    assert iam.meta.endpoint_url == endpoint
+
+
+def test_credentials_file_read_once(config, mock_iam_one_key):
+    """
+    The credentials file should only be parsed once per run, regardless of how many
+    profiles are rotated.
+    """
+    creds_data = "{}\n\n{}".format(
+        credential_section("default", "asdf"), credential_section("nondefault", "asdf")
+    )
+    fake_creds_fp = mock_open(read_data=creds_data)
+    with patch("builtins.open", fake_creds_fp):
+        rotator.IAMKeyRotator(config).main()
+    reads = [call for call in fake_creds_fp.call_args_list if call[0][1:] == ("r",)]
+    assert len(reads) == 1
+
+
+def test_retry_backs_off_exponentially():
+    """
+    InvalidClientTokenId errors are retried with exponentially increasing delays.
+    """
+    error = ClientError({"Error": {"Code": "InvalidClientTokenId"}}, "UpdateAccessKey")
+
+    @rotator.retry(attempts=4, base_delay=1, max_delay=4)
+    def always_fails():
+        raise error
+
+    with patch("aws_key_rotator.rotator.sleep") as mock_sleep, patch(
+        "aws_key_rotator.rotator.random.uniform", return_value=1.0
+    ):
+        with pytest.raises(rotator.MaximumRetriesExceeded):
+            always_fails()
+    assert [call[0][0] for call in mock_sleep.call_args_list] == [1, 2, 4]
+
+
+def test_retry_other_errors_raised_immediately():
+    """
+    Errors other than InvalidClientTokenId should not be retried.
+    """
+    error = ClientError({"Error": {"Code": "AccessDenied"}}, "UpdateAccessKey")
+    calls = []
+
+    @rotator.retry(attempts=4, base_delay=1, max_delay=4)
+    def access_denied():
+        calls.append(None)
+        raise error
+
+    with patch("aws_key_rotator.rotator.sleep") as mock_sleep:
+        with pytest.raises(ClientError):
+            access_denied()
+    assert len(calls) == 1 and mock_sleep.call_count == 0
+
+
+def test_unchanged_credentials_file_not_reparsed(config, tmp_path):
+    """
+    A credentials file that hasn't changed on disk since it was last parsed should be
+    served from the cache.
+    """
+    creds_file = tmp_path / "credentials"
+    creds_file.write_text(credential_section("default", "asdf"))
+    config.credentials = str(creds_file)
+    rotator.IAMKeyRotator(config)._read_credentials()
+    key_rotator = rotator.IAMKeyRotator(config)
+    with patch("builtins.open") as mock_file:
+        contents = key_rotator._read_credentials()
+    assert mock_file.call_count == 0
+    assert contents == credential_section("default", "asdf")
+
+    creds_file.write_text(credential_section("default", "asdf2"))
+    os.utime(str(creds_file), ns=(0, 0))
+    contents = rotator.IAMKeyRotator(config)._read_credentials()
+    assert contents == credential_section("default", "asdf2")
+
+
+def test_credentials_cached_against_signature_before_read(config, tmp_path):
+    """
+    If the file changes while it is being read, the contents should be cached against
+    the signature from before the read, so the next read is a miss.
+    """
+    creds_file = tmp_path / "credentials"
+    creds_file.write_text(credential_section("default", "asdf"))
+    config.credentials = str(creds_file)
+    key_rotator = rotator.IAMKeyRotator(config)
+    with patch(
+        "aws_key_rotator.rotator._file_signature", side_effect=[(1, 1), (2, 2)]
+    ):
+        key_rotator._read_credentials()
+    assert rotator._CONTENTS_CACHE[str(creds_file)][0] == (1, 1)
+
+
+def test_credentials_cache_dropped_after_write(config, mock_iam_one_key, tmp_path):
+    """
+    Writing the credentials file should drop its cache entry rather than caching the
+    written contents against a signature taken after the write.
+    """
+    creds_file = tmp_path / "credentials"
+    creds_file.write_text(credential_section("default", "asdf"))
+    config.credentials = str(creds_file)
+    rotator.IAMKeyRotator(config).main()
+    assert str(creds_file) not in rotator._CONTENTS_CACHE
+    assert creds_file.read_text() == credential_section("default", "asdf2") + "\n"
+
+
+def test_rotatable_profiles_follow_configparser(config):
+    """
+    Profiles are enumerated with ConfigParser's rules for headers, delimiters,
+    indentation and the DEFAULT section.
+    """
+    creds_data = """# comment = ignored
+[DEFAULT]
+region = us-east-1
+
+[a]
+region = x
+
+[b] ; work account
+aws_access_key_id = asdf
+aws_secret_access_key = asdf
+
+[colons]
+aws_access_key_id: asdf
+aws_secret_access_key : asdf
+
+[indented]
+  aws_access_key_id = asdf
+  aws_secret_access_key = asdf
+
+[continued]
+aws_access_key_id = asdf
+    aws_secret_access_key = part of the value above
+"""
+    fake_creds_fp = mock_open(read_data=creds_data)
+    key_rotator = rotator.IAMKeyRotator(config)
+    with patch("builtins.open", fake_creds_fp):
+        profiles = key_rotator._get_rotatable_profiles()
+    assert profiles == ["b", "colons", "indented"]
+
+
+def test_wait_key_active_polls_until_valid(config, mock_iam_one_key):
+    """
+    New credentials are polled with sts:GetCallerIdentity until they are valid, after
+    which the key is inactivated exactly once.
+    """
+    error = ClientError(
+        {"Error": {"Code": "InvalidClientTokenId"}}, "GetCallerIdentity"
+    )
+    mock_iam_one_key.get_caller_identity.side_effect = [error, error, {}]
+    fake_creds_fp = mock_open(read_data=credential_section("default", "asdf"))
+    with patch("builtins.open", fake_creds_fp), patch(
+        "aws_key_rotator.rotator.sleep"
+    ) as mock_sleep:
+        rotator.IAMKeyRotator(config).main()
+    assert mock_iam_one_key.get_caller_identity.call_count == 3
+    assert mock_sleep.call_count == 2
+    assert mock_iam_one_key.update_access_key.call_count == 1
+
+
+@pytest.mark.parametrize("max_workers", ["0", "-1", "abc"])
+def test_max_workers_must_be_positive(max_workers):
+    """
+    Non-positive --max-workers values are rejected when parsing arguments.
+    """
+    with patch("sys.argv", ["aws-key-rotator", "--max-workers", max_workers]):
+        with pytest.raises(SystemExit):
+            cli.parse_args()
+
+
+@pytest.mark.parametrize("min_age_days", ["-1", "abc"])
+def test_min_age_days_must_be_non_negative(min_age_days):
+    """
+    Negative --min-age-days values are rejected when parsing arguments.
+    """
+    with patch("sys.argv", ["aws-key-rotator", "--min-age-days", min_age_days]):
+        with pytest.raises(SystemExit):
+            cli.parse_args()
+
+
 def test_version():
     assert __version__ == "0.1.2"